@@ -1,4 +1,4 @@
-import base64
+import asyncio
 import socketio
 import uvicorn
 from fastapi import FastAPI, responses
@@ -6,21 +6,49 @@ from fastapi.middleware.cors import CORSMiddleware
 import os
 import dotenv
 import random
+import itertools
 import utils
 import uuid
-from typing import Callable, List, Optional
+from typing import Callable, Dict, List, Optional
 from enum import Enum
 import logging
+import logging.handlers
+import queue
+import sys
+import atexit
 
 # ------------------ Logging ------------------
 logging.getLogger("uvicorn").setLevel(logging.CRITICAL)
 logging.getLogger("uvicorn.access").setLevel(logging.CRITICAL)
 
+dotenv.load_dotenv()
+
+# Handlers only enqueue records; the listener thread does the actual writes so
+# the event loop never blocks on stdout.
+logger = logging.getLogger("game")
+_log_level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.setLevel(_log_level if isinstance(_log_level, int) else logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # ------------------ Global state ------------------
 lobbies = {}
 player_to_lobby = {}
 sid_to_id = {}
 id_to_sid = {}
+PLAYER_FREELIST: List["Player"] = []
+PLAYER_FREELIST_MAX = 256
+MAX_PROMPT_LENGTH = 280
+MAX_DRAWING_BYTES = 512 * 1024
+LOBBY_CODE_MIN = 1000
+LOBBY_CODE_SPACE = 999000  # codes 1000..999999
+_LOBBY_CODE_KEYS = [random.getrandbits(10) for _ in range(4)]
+_lobby_seq = itertools.count()
+_lobby_seq_offset = random.randrange(LOBBY_CODE_SPACE)
 
 # ------------------ Utilities ------------------
 def get_id_from_sid(sid: str) -> str:
@@ -29,8 +57,22 @@ def get_id_from_sid(sid: str) -> str:
 def get_sid_from_id(player_id: str) -> str:
     return id_to_sid.get(player_id, player_id)
 
-def event_print(colour: utils.Colors, event: str, *args):
-    print(f"{colour}[{event}]{utils.Colors.END}", *args)
+def event_print(colour: utils.Colors, event: str, *args, level: int = logging.DEBUG):
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s[%s]%s %s", colour, event, utils.Colors.END, " ".join(map(str, args)))
+
+def _feistel20(x: int) -> int:
+    left, right = x >> 10, x & 0x3FF
+    for key in _LOBBY_CODE_KEYS:
+        left, right = right, left ^ (((right * 0x9E5 + key) ^ (right >> 3)) & 0x3FF)
+    return (left << 10) | right
+
+def _permute_lobby_index(n: int) -> int:
+    # Cycle-walk the 20-bit permutation until it lands back inside the code space
+    n = _feistel20(n)
+    while n >= LOBBY_CODE_SPACE:
+        n = _feistel20(n)
+    return n
 
 def get_lobby_and_player(player_id: str):
     lobby_code = player_to_lobby.get(player_id)
@@ -48,83 +90,130 @@ class GameState(Enum):
     PRESENTING = "presenting"
     END = "end"
 
+# Wire values for game_state emits, resolved once instead of per emit
+WRITING = sys.intern(GameState.WRITING.value)
+DRAWING = sys.intern(GameState.DRAWING.value)
+END = sys.intern(GameState.END.value)
+
 # ------------------ Player & Lobby ------------------
 class Player:
+    __slots__ = ("_as_dict", "id", "username", "prompt_written", "prompt_given",
+                 "drawing_data", "last_voted_round", "voting_score")
+
     def __init__(self, id: str, username: str):
+        self._as_dict = {}
+        self._reset(id, username)
+
+    def _reset(self, id: str, username: str):
         self.id = id
         self.username = username
         self.prompt_written: Optional[str] = None
         self.prompt_given: Optional[str] = None
         self.drawing_data: Optional[bytes] = None
-        self.voted_already: bool = False
+        self.last_voted_round: int = -1
         self.voting_score: int = 0
 
+    @classmethod
+    def acquire(cls, id: str, username: str) -> "Player":
+        if PLAYER_FREELIST:
+            player = PLAYER_FREELIST.pop()
+            player._reset(id, username)
+            return player
+        return cls(id, username)
+
+    def release(self):
+        self._reset(None, None)
+        if len(PLAYER_FREELIST) < PLAYER_FREELIST_MAX:
+            PLAYER_FREELIST.append(self)
+
     def get_as_dict(self):
-        return {
-            "id": self.id,
-            "username": self.username,
-            "prompt_written": self.prompt_written,
-            "prompt_given": self.prompt_given
-        }
+        # Reused between calls; only valid until the emit it is passed to returns
+        d = self._as_dict
+        d["id"] = self.id
+        d["username"] = self.username
+        d["prompt_written"] = self.prompt_written
+        d["prompt_given"] = self.prompt_given
+        return d
 
 class Lobby:
+    __slots__ = ("host_id", "lobby_code", "players", "players_by_id", "current_state",
+                 "prompts_submitted", "vote_round")
+
     def __init__(self, host_id: str):
         self.host_id = host_id
-        self.lobby_code = self._generate_lobby_code()
+        self.lobby_code: str = self._generate_lobby_code()
         self.players: List[Player] = []
+        self.players_by_id: Dict[str, Player] = {}
         self.current_state = GameState.WAITING
+        self.prompts_submitted = 0
+        self.vote_round = 0
 
     @staticmethod
     def _generate_lobby_code():
-        while True:
-            code = random.randint(1000, 999999)
-            if str(code) not in lobbies:
-                return code
+        n = next(_lobby_seq)
+        code = f"{_permute_lobby_index((n + _lobby_seq_offset) % LOBBY_CODE_SPACE) + LOBBY_CODE_MIN}"
+        if n < LOBBY_CODE_SPACE:
+            return code
+        # The counter has wrapped, so codes can repeat; skip any still in use
+        while code in lobbies:
+            code = f"{random.randint(1000, 999999)}"
+        return code
+
+    def get_players_as_dicts(self):
+        return [p.get_as_dict() for p in self.players]
 
     async def add_player(self, player: Player, callback: Optional[Callable] = None):
         self.players.append(player)
+        self.players_by_id[player.id] = player
         if callback:
             await callback(player)
 
     async def remove_player(self, player_id: str, callback: Optional[Callable] = None):
-        player = next((p for p in self.players if p.id == player_id), None)
+        player = self.players_by_id.pop(player_id, None)
         if player:
             self.players.remove(player)
+            if player.prompt_written:
+                self.prompts_submitted -= 1
             if callback:
                 await callback(player)
+            player.release()
 
 # ------------------ FastAPI + CORS ------------------
-dotenv.load_dotenv()
 app = FastAPI(docs_url="/docs")
 
 origins = ["*.latific.click"]
 if os.getenv("INSECURE_CORS", "0").lower() in ("1", "true", "yes"):
     origins = "*"
-    event_print(utils.Colors.RED, "CORS", "USING INSECURE CORS!")
+    event_print(utils.Colors.RED, "CORS", "USING INSECURE CORS!", level=logging.WARNING)
 
+# Only covers the FastAPI routes; /socket.io/ is answered by socketio.ASGIApp
+# before this middleware runs and uses cors_allowed_origins instead.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization", "X-Requested-With"],
 )
 
 # ------------------ Socket.IO ------------------
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins=origins, ping_timeout=8, ping_interval=5)
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins=origins, ping_timeout=8, ping_interval=5,
+                           # Polling sends binary attachments base64-encoded, so allow for the 4/3 inflation
+                           max_http_buffer_size=MAX_DRAWING_BYTES * 4 // 3 + 64 * 1024,
+                           json=utils.OrjsonJSON if utils.orjson else None)
 asgi_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
 # ------------------ Matchmaking & Connection ------------------
 @sio.event
 async def connect(sid, environ):
-    event_print(utils.Colors.GREEN, "CONNECT", f"New connection: {sid}")
+    event_print(utils.Colors.GREEN, "CONNECT", "New connection:", sid)
 
 @sio.event
 async def assign_id(sid, data):
     player_id = data or uuid.uuid4().hex
     sid_to_id[sid] = player_id
     id_to_sid[player_id] = sid
-    event_print(utils.Colors.GREEN, "ASSIGN_ID", f"Assigned player_id: {player_id}")
+    event_print(utils.Colors.GREEN, "ASSIGN_ID", "Assigned player_id:", player_id)
     await sio.emit("assign_id", player_id, sid)
 
 @sio.event
@@ -138,24 +227,17 @@ async def disconnect(sid):
     if not lobby:
         return
     if lobby.host_id == player_id:
+        await sio.emit("disconnected", "The host has disconnected from the game!", room=lobby_code, skip_sid=sid)
+        await sio.close_room(lobby_code)
         for p in lobby.players:
-            if p.id != player_id:
-                sid_ = id_to_sid.pop(p.id, None)
-                player_to_lobby.pop(p.id, None)
-                sid_to_id.pop(sid_, None)
-                if sid_:
-                    await sio.emit("disconnected", "The host has disconnected from the game!", sid_)
+            sid_to_id.pop(id_to_sid.pop(p.id, None), None)
+            player_to_lobby.pop(p.id, None)
+            p.release()
         del lobbies[lobby_code]
     else:
         await lobby.remove_player(player_id)
-        players = [p.get_as_dict() for p in lobby.players]
-        host_sid = id_to_sid.get(lobby.host_id)
-        if host_sid:
-            await sio.emit("players_update", players, host_sid)
-        for p in lobby.players:
-            sid_ = id_to_sid.get(p.id)
-            if sid_ and sid_ != host_sid:
-                await sio.emit("players_update", players, sid_)
+        players = lobby.get_players_as_dicts()
+        await sio.emit("players_update", players, room=lobby_code)
 
 # ------------------ Lobby Events ------------------
 @sio.event
@@ -164,6 +246,7 @@ async def create_lobby(sid, data):
     lobby = Lobby(host_id)
     lobbies[lobby.lobby_code] = lobby
     player_to_lobby[host_id] = lobby.lobby_code
+    await sio.enter_room(sid, lobby.lobby_code)
     await sio.emit("lobby_created", lobby.lobby_code, sid)
 
 @sio.event
@@ -173,6 +256,7 @@ async def join_lobby(sid, data):
     if not username or not lobby_code:
         await sio.emit("error", "Username and lobby_code are required!", sid)
         return
+    lobby_code = str(lobby_code)
     lobby: Lobby = lobbies.get(lobby_code)
     if not lobby:
         await sio.emit("error", "Lobby not found!", sid)
@@ -183,11 +267,16 @@ async def join_lobby(sid, data):
     if len(lobby.players) >= 12:
         await sio.emit("error", "Lobby is full!", sid)
         return
-    player = Player(get_id_from_sid(sid), username)
+    player_id = get_id_from_sid(sid)
+    if player_id in lobby.players_by_id:
+        await sio.emit("error", "Already in this lobby!", sid)
+        return
+    player = Player.acquire(player_id, username)
     player_to_lobby[player.id] = lobby.lobby_code
     async def on_join(p):
+        await sio.enter_room(sid, lobby.lobby_code)
         await sio.emit("joined_lobby", lobby.lobby_code, sid)
-        players = [pl.get_as_dict() for pl in lobby.players]
+        players = lobby.get_players_as_dicts()
         host_sid = id_to_sid.get(lobby.host_id)
         if host_sid:
             await sio.emit("players_update", players, host_sid)
@@ -199,8 +288,7 @@ async def cancel_game(sid, data):
     lobby, _ = get_lobby_and_player(player_id)
     if not lobby:
         return
-    for player in lobby.players:
-        await sio.emit("cancel_game", data, get_sid_from_id(player.id))
+    await sio.emit("cancel_game", data, room=lobby.lobby_code, skip_sid=get_sid_from_id(lobby.host_id))
 
 # ------------------ Game Flow ------------------
 @sio.event
@@ -210,20 +298,28 @@ async def start_game(sid, data):
     if not lobby:
         return
     lobby.current_state = GameState.WRITING
+    lobby.prompts_submitted = 0
     for p in lobby.players:
-        await sio.emit("game_state", GameState.WRITING.value, get_sid_from_id(p.id))
+        p.prompt_written = None
+    await sio.emit("game_state", WRITING, room=lobby.lobby_code, skip_sid=get_sid_from_id(lobby.host_id))
 
 @sio.event
 async def submit_prompt(sid, data):
+    prompt = str(data.get('prompt') or "")[:MAX_PROMPT_LENGTH]
+    if not prompt:
+        await sio.emit("error", "Prompt cannot be empty!", sid)
+        return
     player_id = get_id_from_sid(sid)
     lobby, _ = get_lobby_and_player(player_id)
     if not lobby:
         return
-    for p in lobby.players:
-        if p.id == player_id:
-            p.prompt_written = data['prompt']
-            await sio.emit("writing_submitted", to=get_sid_from_id(player_id))
-    if all(p.prompt_written for p in lobby.players):
+    p = lobby.players_by_id.get(player_id)
+    if p:
+        if not p.prompt_written:
+            lobby.prompts_submitted += 1
+        p.prompt_written = prompt
+        await sio.emit("writing_submitted", to=get_sid_from_id(player_id))
+    if lobby.prompts_submitted == len(lobby.players):
         await sio.emit("finish_writing", len(lobby.players), get_sid_from_id(lobby.host_id))
 
 @sio.event
@@ -233,14 +329,16 @@ async def hand_out_prompts(sid):
     if not lobby:
         return
     players = lobby.players
-    prompt_pool = [{"id": uuid.uuid4(), "text": p.prompt_written, "owner": p.id} for p in players]
-    while True:
-        random.shuffle(prompt_pool)
-        if all(players[i].id != prompt_pool[i]["owner"] for i in range(len(players))):
-            break
+    prompt_pool = [p.prompt_written for p in players]
+    # Sattolo's shuffle: a single random cycle, so nobody gets their own prompt back
+    for i in range(len(prompt_pool) - 1, 0, -1):
+        j = random.randrange(i)
+        prompt_pool[i], prompt_pool[j] = prompt_pool[j], prompt_pool[i]
+    sends = []
     for i, player in enumerate(players):
-        player.prompt_given = prompt_pool[i]["text"]
-        await sio.emit("give_prompt", player.prompt_given, get_sid_from_id(player.id))
+        player.prompt_given = prompt_pool[i]
+        sends.append(sio.emit("give_prompt", player.prompt_given, get_sid_from_id(player.id)))
+    await asyncio.gather(*sends)
     await sio.emit("start_viewing", "", sid)
 
 @sio.event
@@ -249,20 +347,25 @@ async def start_drawing(sid):
     lobby, _ = get_lobby_and_player(player_id)
     if not lobby:
         return
-    await sio.emit("drawing_started", GameState.DRAWING.value, sid)
-    for p in lobby.players:
-        await sio.emit("game_state", GameState.DRAWING.value, get_sid_from_id(p.id))
+    await sio.emit("drawing_started", DRAWING, sid)
+    await sio.emit("game_state", DRAWING, room=lobby.lobby_code, skip_sid=get_sid_from_id(lobby.host_id))
 
 @sio.event
 async def submit_drawing(sid, array_buffer, meta=None):
     meta = meta or {}
+    if not isinstance(array_buffer, (bytes, bytearray)):
+        await sio.emit("error", "Drawing must be binary!", sid)
+        return
+    if len(array_buffer) > MAX_DRAWING_BYTES:
+        await sio.emit("error", "Drawing is too large!", sid)
+        return
     player_id = get_id_from_sid(sid)
     lobby, _ = get_lobby_and_player(player_id)
     if not lobby:
         return
-    for p in lobby.players:
-        if p.id == player_id:
-            p.drawing_data = array_buffer
+    p = lobby.players_by_id.get(player_id)
+    if p:
+        p.drawing_data = array_buffer
 
 @sio.event
 async def end_drawing(sid):
@@ -270,8 +373,7 @@ async def end_drawing(sid):
     lobby, _ = get_lobby_and_player(player_id)
     if not lobby:
         return
-    for p in lobby.players:
-        await sio.emit("end_drawing", None, get_sid_from_id(p.id))
+    await sio.emit("end_drawing", None, room=lobby.lobby_code, skip_sid=get_sid_from_id(lobby.host_id))
 
 @sio.event
 async def start_presenting(sid):
@@ -283,7 +385,7 @@ async def start_presenting(sid):
         p.id: {
             "username": p.username,
             "prompt": p.prompt_given,
-            "drawing_data": base64.b64encode(p.drawing_data).decode("utf-8") if p.drawing_data else None
+            "drawing_data": p.drawing_data or None
         }
         for p in lobby.players
     }
@@ -295,12 +397,12 @@ async def set_presenter(sid, data):
     lobby, _ = get_lobby_and_player(player_id)
     if not lobby:
         return
-    for p in lobby.players:
-        p.voted_already = False
-        if data['id'] == p.id:
-            await sio.emit("you_are_presenting", data, get_sid_from_id(p.id))
-        else:
-            await sio.emit("current_presenter", data, get_sid_from_id(p.id))
+    if data['id'] not in lobby.players_by_id:
+        return
+    lobby.vote_round += 1
+    presenter_sid = get_sid_from_id(data['id'])
+    await sio.emit("you_are_presenting", data, presenter_sid)
+    await sio.emit("current_presenter", data, room=lobby.lobby_code, skip_sid=[presenter_sid, get_sid_from_id(lobby.host_id)])
 
 @sio.event
 async def vote_presentation(sid, data):
@@ -308,14 +410,11 @@ async def vote_presentation(sid, data):
     lobby, _ = get_lobby_and_player(player_id)
     if not lobby:
         return
-    for p in lobby.players:
-        if p.id == player_id and data['id'] != p.id and not p.voted_already:
-            p.voted_already = True
-            for target in lobby.players:
-                if target.id == data['id']:
-                    target.voting_score += data['score']
-                    break
-            break
+    voter = lobby.players_by_id.get(player_id)
+    target = lobby.players_by_id.get(data['id'])
+    if voter and target and voter is not target and voter.last_voted_round != lobby.vote_round:
+        voter.last_voted_round = lobby.vote_round
+        target.voting_score += data['score']
     await sio.emit("voted", None, sid)
 
 @sio.event
@@ -331,7 +430,7 @@ async def done_presenting(sid):
             "username": p.username,
             "score": p.voting_score
         })
-        await sio.emit("game_state", "end", get_sid_from_id(p.id))
+    await sio.emit("game_state", END, room=lobby.lobby_code, skip_sid=get_sid_from_id(lobby.host_id))
     await sio.emit("game_end", player_stats, sid)
 
 @sio.event
@@ -362,7 +461,12 @@ if __name__ == "__main__":
         lan_ip = None
 
     port = int(os.environ.get("PORT", 8000))
-    event_print(utils.Colors.GREEN, "MAIN", f"Starting webserver on 0.0.0.0:{port}")
+    event_print(utils.Colors.GREEN, "MAIN", f"Starting webserver on 0.0.0.0:{port}", level=logging.INFO)
     if lan_ip:
-        event_print(utils.Colors.GREEN, "MAIN", f"LAN IP: {lan_ip}:{port}")
-    uvicorn.run(asgi_app, host="0.0.0.0", port=port, log_level="critical")
+        event_print(utils.Colors.GREEN, "MAIN", f"LAN IP: {lan_ip}:{port}", level=logging.INFO)
+    # Lobbies and the sid/id maps live in process memory, so this has to stay on a
+    # single worker. Scaling out would need a socketio.AsyncRedisManager plus shared
+    # lobby state. uvicorn[standard] provides uvloop/httptools where the platform
+    # supports them and the default "auto" settings pick them up.
+    # permessage-deflate is off: control frames are tiny and drawings are already PNG.
+    uvicorn.run(asgi_app, host="0.0.0.0", port=port, ws_per_message_deflate=False, workers=1, log_level="critical")
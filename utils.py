@@ -1,3 +1,8 @@
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class Colors:
     """ ANSI color codes """
     BLACK = "\033[0;30m"
@@ -34,4 +39,15 @@ class Colors:
         if __import__("platform").system() == "Windows":
             kernel32 = __import__("ctypes").windll.kernel32
             kernel32.SetConsoleMode(kernel32.GetStdHandle(-11), 7)
-            del kernel32
\ No newline at end of file
+            del kernel32
+
+class OrjsonJSON:
+    """ json module stand-in backed by orjson, for socketio.AsyncServer(json=...) """
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        # stdlib json stringifies non-str keys; orjson rejects them unless asked
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)